@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os
 import re
 import time
+import functools
 import collections
 import urllib.parse
+from html import unescape
 
 import bs4
 
@@ -24,17 +25,40 @@ DATETIME_FMTs = (
 (re.compile(r'\d+/\d+/\d{4} \d{2}:\d{2}:\d{2} [+-]\d{4}'), "%d/%m/%Y %H:%M:%S %z"),
 (re.compile(r'\d{2} [A-S][a-y]{2} \d{4}'), "%d %b %Y")
 )
+# all of the above in one pass, the first matching alternative wins
+RE_DATETIME = re.compile('|'.join(
+    '(?P<fmt%d>%s)' % (i, regex.pattern)
+    for i, (regex, fmt) in enumerate(DATETIME_FMTs)))
+DATETIME_FMT_LIST = [fmt for regex, fmt in DATETIME_FMTs]
 
 RE_FILESIZE = re.compile(r'\d+(\.\d+)? ?[BKMGTPEZY]|\d+|-', re.I)
 RE_ABSPATH = re.compile(r'^((ht|f)tps?:/)?/')
+ABSPATH_PREFIXES = ('/', 'http://', 'https://', 'ftp://', 'ftps://')
 RE_COMMONHEAD = re.compile('Name|(Last )?modifi(ed|cation)|date|Size|Description|Metadata|Type|Parent Directory', re.I)
 RE_HASTEXT = re.compile('.+')
 RE_HEAD_NAME = re.compile('name$|^file|^download')
 RE_HEAD_MOD = re.compile('modifi|^uploaded|date|time')
 RE_HEAD_SIZE = re.compile('size|bytes$')
+# one line of nginx autoindex output
+RE_NGINX_ENTRY = re.compile(
+    rb'^<a href="([^"]+)">[^<\n]*</a>[ \t]+'
+    rb'(\d+-[A-S][a-y]{2}-\d{4} \d+:\d{2}(?::\d{2})?)[ \t]+'
+    rb'(\d+(?:\.\d+)?[KMGTPEZY]?|-)[ \t]*\r?$', re.M)
+
+SIZE_PREFIX = {
+    'B': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40,
+    'P': 1 << 50, 'E': 1 << 60, 'Z': 1 << 70, 'Y': 1 << 80
+}
 
 FileEntry = collections.namedtuple('FileEntry', 'name modified size description')
 
+STRPTIME_CACHE_SIZE = 4096
+
+@functools.lru_cache(maxsize=STRPTIME_CACHE_SIZE)
+def _strptime(timestr, fmt):
+    # listings tend to have many identical timestamps
+    return time.strptime(timestr, fmt)
+
 def human2bytes(s):
     """
     >>> human2bytes('1M')
@@ -44,27 +68,98 @@ def human2bytes(s):
     """
     if s is None:
         return None
-    try:
-        return int(s)
-    except ValueError:
-        symbols = 'BKMGTPEZY'
-        letter = s[-1:].strip().upper()
-        num = float(s[:-1])
-        prefix = {symbols[0]: 1}
-        for i, s in enumerate(symbols[1:]):
-            prefix[s] = 1 << (i+1)*10
-        return int(num * prefix[letter])
+    prefix = SIZE_PREFIX.get(s[-1:].upper())
+    if prefix is None:
+        try:
+            return int(s)
+        except ValueError:
+            # float() first, so malformed sizes still raise ValueError
+            return int(float(s[:-1]) * SIZE_PREFIX[s[-1:].strip().upper()])
+    return int(float(s[:-1]) * prefix)
 
 def aherf2filename(a_href):
-    isdir = ('/' if a_href[-1] == '/' else '')
-    return os.path.basename(urllib.parse.unquote(a_href.rstrip('/'))) + isdir
+    isdir = ('/' if a_href.endswith('/') else '')
+    path = a_href.rstrip('/')
+    if '%' in path:
+        path = urllib.parse.unquote(path)
+    return path.rsplit('/', 1)[-1] + isdir
+
+def _td_name(td, entry, status):
+    if not td.a:
+        return status
+    a_str = td.a.get_text().strip()
+    a_href = td.a['href']
+    if not a_str or not a_href or a_href[0] == '#':
+        return status
+    elif a_str == 'Parent Directory' or a_href == '../':
+        return None
+    entry['name'] = aherf2filename(a_href)
+    return 1
+
+def _td_modified(td, entry, status):
+    if td.time:
+        timestr = td.time.get('datetime', '')
+        if RE_ISO8601.match(timestr):
+            entry['modified'] = _strptime(timestr, "%Y-%m-%dT%H:%M:%SZ")
+            return status + 1
+    timestr = td.get_text().strip()
+    if timestr:
+        match = RE_DATETIME.match(timestr)
+        if match:
+            entry['modified'] = _strptime(match.group(0),
+                DATETIME_FMT_LIST[int(match.lastgroup[3:])])
+        else:
+            sort_value = td.get('data-sort-value')
+            if sort_value:
+                entry['modified'] = time.gmtime(int(sort_value))
+            # else:
+                # raise AssertionError(
+                    # "can't identify date/time format")
+    return status + 1
+
+def _td_size(td, entry, status):
+    sizestr = td.get_text().strip().replace(',', '')
+    sort_value = td.get('data-sort-value')
+    if sizestr == '-' or not sizestr:
+        entry['size'] = None
+    elif sort_value:
+        entry['size'] = int(sort_value)
+    else:
+        match = RE_FILESIZE.match(sizestr)
+        if match:
+            entry['size'] = human2bytes(match.group(0).replace(' ', ''))
+        else:
+            entry['size'] = None
+    return status + 1
+
+def _td_description(td, entry, status):
+    if not entry['description']:
+        for img in td.find_all('img'):
+            img.decompose()
+        entry['description'] = td.decode_contents().strip(
+            ' \t\n\r\x0b\x0c\xa0') or None
+    return status + 1
+
+def _td_unknown(td, entry, status):
+    return status + 1 if status else status
+
+# Table cell handlers by column type.
+# Each one fills `entry` from `td` and returns the next column index,
+# or None to skip the rest of the row.
+TD_HANDLERS = {
+    'name': _td_name,
+    'modified': _td_modified,
+    'size': _td_size,
+    'description': _td_description,
+}
 
 def parse(soup):
     '''
     Try to parse apache/nginx-style directory listing with all kinds of tricks.
 
     Exceptions or an empty listing suggust a failure.
-    We strongly recommend generating the `soup` with 'html5lib'.
+    We recommend generating the `soup` with 'lxml' or 'html5lib',
+    see `make_soup`.
 
     Returns: Current directory, Directory listing
     '''
@@ -76,15 +171,24 @@ def parse(soup):
         title = soup.h1.get_text().strip()
         if title.startswith('Index of '):
             cwd = title[9:]
-    [img.decompose() for img in soup.find_all('img')]
     file_name = file_mod = file_size = file_desc = None
-    pres = [x for x in soup.find_all('pre') if
-            x.find('a', string=RE_HASTEXT)]
-    tables = [x for x in soup.find_all('table') if
-              x.find(string=RE_COMMONHEAD)] if not pres else ()
+    pre = None
+    for x in soup.find_all('pre'):
+        # icons inside links would hide the link text from .string
+        for img in x.find_all('img'):
+            img.decompose()
+        if x.find('a', string=RE_HASTEXT):
+            pre = x
+            break
+    table = next((x for x in soup.find_all('table') if
+                  x.find(string=RE_COMMONHEAD)), None) if pre is None else None
     heads = []
-    if pres:
-        pre = pres[0]
+    if pre is not None:
+        # local names for lookups done on every line
+        match_datetime = RE_DATETIME.match
+        match_filesize = RE_FILESIZE.match
+        datetime_fmts = DATETIME_FMT_LIST
+        strptime = _strptime
         started = False
         for element in (pre.hr.next_siblings if pre.hr else pre.children):
             if element.name == 'a':
@@ -106,13 +210,12 @@ def parse(soup):
                     started = True
             elif not element.name:
                 line = element.string.replace('\r', '').split('\n', 1)[0].lstrip()
-                for regex, fmt in DATETIME_FMTs:
-                    match = regex.match(line)
-                    if match:
-                        file_mod = time.strptime(match.group(0), fmt)
-                        line = line[match.end():].lstrip()
-                        break
-                match = RE_FILESIZE.match(line)
+                match = match_datetime(line)
+                if match:
+                    file_mod = strptime(match.group(0),
+                        datetime_fmts[int(match.lastgroup[3:])])
+                    line = line[match.end():].lstrip()
+                match = match_filesize(line)
                 if match:
                     sizestr = match.group(0)
                     if sizestr == '-':
@@ -129,97 +232,51 @@ def parse(soup):
                 continue
         if file_name:
             listing.append(FileEntry(file_name, file_mod, file_size, file_desc))
-    elif tables:
+    elif table is not None:
         started = False
-        for tr in tables[0].find_all('tr'):
+        handlers = None
+        for tr in table.find_all('tr'):
             status = 0
-            file_name = file_mod = file_size = file_desc = None
+            entry = dict.fromkeys(FileEntry._fields)
             if started:
                 if tr.parent.name in ('thead', 'tfoot') or tr.th:
                     continue
-                for td in tr.find_all('td'):
-                    if status >= len(heads):
+                if handlers is None:
+                    handlers = [TD_HANDLERS.get(head, _td_unknown)
+                                for head in heads]
+                for td in tr.find_all('td', recursive=False):
+                    if status >= len(handlers):
                         raise AssertionError("can't detect table column number")
                     if td.get('colspan'):
                         continue
-                    elif heads[status] == 'name':
-                        if not td.a:
-                            continue
-                        a_str = td.a.get_text().strip()
-                        a_href = td.a['href']
-                        if not a_str or not a_href or a_href[0] == '#':
-                            continue
-                        elif a_str == 'Parent Directory' or a_href == '../':
-                            break
-                        else:
-                            file_name = aherf2filename(a_href)
-                            status = 1
-                    elif heads[status] == 'modified':
-                        if td.time:
-                            timestr = td.time.get('datetime', '')
-                            if RE_ISO8601.match(timestr):
-                                file_mod = time.strptime(timestr, "%Y-%m-%dT%H:%M:%SZ")
-                                status += 1
-                                continue
-                        timestr = td.get_text().strip()
-                        if timestr:
-                            for regex, fmt in DATETIME_FMTs:
-                                match = regex.match(timestr)
-                                if match:
-                                    file_mod = time.strptime(match.group(0), fmt)
-                                    break
-                            else:
-                                if td.get('data-sort-value'):
-                                    file_mod = time.gmtime(int(td['data-sort-value']))
-                                # else:
-                                    # raise AssertionError(
-                                        # "can't identify date/time format")
-                        status += 1
-                    elif heads[status] == 'size':
-                        sizestr = td.get_text().strip().replace(',', '')
-                        if sizestr == '-' or not sizestr:
-                            file_size = None
-                        elif td.get('data-sort-value'):
-                            file_size = int(td['data-sort-value'])
-                        else:
-                            match = RE_FILESIZE.match(sizestr)
-                            if match:
-                                file_size = human2bytes(
-                                    match.group(0).replace(' ', ''))
-                            else:
-                                file_size = None
-                        status += 1
-                    elif heads[status] == 'description':
-                        file_desc = file_desc or ''.join(map(str, td.children)
-                                        ).strip(' \t\n\r\x0b\x0c\xa0') or None
-                        status += 1
-                    elif status:
-                        # unknown header
-                        status += 1
-                if file_name:
-                    listing.append(FileEntry(
-                        file_name, file_mod, file_size, file_desc))
+                    status = handlers[status](td, entry, status)
+                    if status is None:
+                        break
+                if entry['name']:
+                    listing.append(FileEntry(**entry))
             elif tr.hr:
                 started = True
                 continue
             elif tr.find(string=RE_COMMONHEAD):
                 namefound = False
                 colspan = False
-                for th in (tr.find_all('th') if tr.th else tr.find_all('td')):
+                for th in tr.find_all('th' if tr.th else 'td', recursive=False):
                     if th.get('colspan'):
                         colspan = True
                         continue
                     name = th.get_text().strip(' \t\n\r\x0b\x0c\xa0↑↓').lower()
                     if not name:
                         continue
-                    elif not namefound and RE_HEAD_NAME.search(name):
+                    elif not namefound and (name.endswith('name') or
+                            name.startswith(('file', 'download'))):
                         heads.append('name')
                         namefound = True
                     elif name in ('size', 'description'):
                         heads.append(name)
-                    elif RE_HEAD_MOD.search(name):
+                    elif ('modifi' in name or 'date' in name or
+                            'time' in name or name.startswith('uploaded')):
                         heads.append('modified')
-                    elif RE_HEAD_SIZE.search(name):
+                    elif 'size' in name or name.endswith('bytes'):
                         heads.append('size')
                     elif name.endswith('signature'):
                         heads.append('signature')
@@ -240,29 +297,77 @@ def parse(soup):
                 continue
             file_name = urllib.parse.unquote(a['href'])
             if (file_name in {'Parent Directory', '.', './', '..', '../', '#'}
-                or RE_ABSPATH.match(file_name)):
+                or file_name.startswith(ABSPATH_PREFIXES)):
                 continue
             else:
                 listing.append(FileEntry(file_name, None, None, None))
     return cwd, listing
 
-def fetch_listing(url, timeout=30, **requests_kwargs):
-    import requests
-    req = requests.get(url, timeout=timeout, **requests_kwargs)
+def parse_nginx(content):
+    '''
+    Parse nginx autoindex output from raw bytes without building a soup.
+
+    Returns: Directory listing, or None if `content` doesn't look exactly
+    like nginx autoindex output, in which case use `parse`.
+    '''
+    listing = []
+    for match in RE_NGINX_ENTRY.finditer(content):
+        href, timestr, sizestr = match.groups()
+        timestr = timestr.decode('ascii')
+        sizestr = sizestr.decode('ascii')
+        listing.append(FileEntry(
+            aherf2filename(unescape(href.decode('utf-8', 'replace'))),
+            _strptime(timestr, DATETIME_FMT_LIST[
+                int(RE_DATETIME.match(timestr).lastgroup[3:])]),
+            None if sizestr == '-' else human2bytes(sizestr),
+            None
+        ))
+    if len(listing) != (content.count(b'<a href="') -
+                        content.count(b'<a href="../">')):
+        return None
+    return listing
+
+def make_soup(html, parser='lxml'):
+    '''
+    Make a BeautifulSoup from `html` for `parse`.
+
+    The fast C-based 'lxml' parser is used by default. Falls back to
+    'html5lib' if the requested parser is not installed.
+    '''
+    try:
+        return bs4.BeautifulSoup(html, parser)
+    except bs4.FeatureNotFound:
+        return bs4.BeautifulSoup(html, 'html5lib')
+
+_session = None
+
+def _get_session():
+    global _session
+    if _session is None:
+        import requests
+        _session = requests.Session()
+    return _session
+
+def fetch_listing(url, timeout=30, parser='lxml', session=None,
+                  **requests_kwargs):
+    if session is None:
+        session = _get_session()
+    req = session.get(url, timeout=timeout, **requests_kwargs)
     req.raise_for_status()
-    soup = bs4.BeautifulSoup(req.content, 'html5lib')
+    soup = make_soup(req.content, parser)
     return parse(soup)
 
 if __name__ == '__main__':
     import sys
     import requests
-    for url in sys.argv[1:] or ('http://httpredir.debian.org/debian/',):
-        req = requests.get(url, timeout=30)
-        req.raise_for_status()
-        print(req.url)
-        soup = bs4.BeautifulSoup(req.content, 'html5lib')
-        cwd, listing = parse(soup)
-        print('Cwd:', cwd)
-        for f in listing:
-            print(f)
-        print()
+    with requests.Session() as session:
+        for url in sys.argv[1:] or ('http://httpredir.debian.org/debian/',):
+            req = session.get(url, timeout=30)
+            req.raise_for_status()
+            print(req.url)
+            soup = make_soup(req.content)
+            cwd, listing = parse(soup)
+            print('Cwd:', cwd)
+            for f in listing:
+                print(f)
+            print()
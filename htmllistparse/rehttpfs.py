@@ -3,16 +3,21 @@
 
 import os
 import io
+import re
 import stat
 import time
 import logging
 import argparse
 import calendar
+import operator
+import functools
+import threading
+import collections
 import urllib.parse
 from errno import EACCES, ENOENT, EIO
 from email.utils import parsedate
 
-import bs4
+import urllib3
 import requests
 import htmllistparse
 try:
@@ -24,27 +29,53 @@ CONFIG = {
     'timeout': None,
     'user_agent': None,
 }
+CONTENT_CHUNK_SIZE = 128 * 1024
+# FUSE calls come from many threads, keep enough connections alive
+HTTP_ADAPTER = requests.adapters.HTTPAdapter(
+    pool_connections=32, pool_maxsize=64)
 SESSION = requests.Session()
-CONTENT_CHUNK_SIZE = 10 * 1024
-
-
-def parse_dir(html):
-    return htmllistparse.parse(bs4.BeautifulSoup(html, 'html5lib'))
-
-
+SESSION.mount('http://', HTTP_ADAPTER)
+SESSION.mount('https://', HTTP_ADAPTER)
+CACHE_SIZE = 8192
+# seconds before cached stats are fetched again
+CACHE_TTL = 60
+NEGATIVE_CACHE_TTL = 30
+RE_MAX_AGE = re.compile(r'max-age=(\d+)')
+SIZE_UNITS = ('', 'K', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y')
+# errors from a dropped or timed out connection while reading a response
+STREAM_ERRORS = (
+    requests.exceptions.RequestException,
+    urllib3.exceptions.HTTPError,
+    OSError
+)
+
+
+def parse_dir(html, server=''):
+    if server.startswith('nginx'):
+        listing = htmllistparse.parse_nginx(html)
+        if listing:
+            return None, listing
+    return htmllistparse.parse(htmllistparse.make_soup(html))
+
+
+@functools.lru_cache(maxsize=65536)
 def make_url(urlbase, name):
     return urllib.parse.urljoin(urlbase, urllib.parse.quote(name.lstrip('/')))
 
 
+def cache_max_age(headers):
+    cache_control = headers.get('Cache-Control', '').lower()
+    if 'no-cache' in cache_control or 'no-store' in cache_control:
+        return 0
+    match = RE_MAX_AGE.search(cache_control)
+    return int(match.group(1)) if match else 0
+
+
 def sizeof_fmt(num):
-    for unit in ('', 'K', 'M', 'G', 'T', 'P', 'E', 'Z'):
-        if abs(num) < 1024:
-            if unit:
-                return "%3.1f%s" % (num, unit)
-            else:
-                return int(num)
-        num /= 1024.0
-    return "%.1f%s" % (num, 'Y')
+    unit = min((abs(int(num)).bit_length() - 1) // 10, len(SIZE_UNITS) - 1)
+    if unit <= 0:
+        return int(num)
+    return "%3.1f%s" % (num / (1 << unit*10), SIZE_UNITS[unit])
 
 
 def convert_fuse_options(options):
@@ -68,10 +99,11 @@ class FileStat:
         'st_mode', 'st_nlink', 'st_uid', 'st_gid', 'st_size',
         'st_atime', 'st_mtime', 'st_ctime'
     )
+    _values = operator.attrgetter(*__slots__)
 
-    def __init__(self):
-        self.st_mode = stat.S_IFREG | 0o444
-        self.st_nlink = 1
+    def __init__(self, mode=stat.S_IFREG | 0o444, nlink=1):
+        self.st_mode = mode
+        self.st_nlink = nlink
         self.st_uid = 0
         self.st_gid = 0
         self.st_size = 0
@@ -92,18 +124,63 @@ class FileStat:
         return getattr(self, key)
 
     def items(self):
-        for key in self.__slots__:
-            yield key, getattr(self, key)
+        return zip(self.__slots__, self._values(self))
 
     def __repr__(self):
         return '<FileStat mode=%o, size=%s, mtime=%d>' % (
             self.st_mode, sizeof_fmt(self.st_size), self.st_mtime)
 
 
+class MetaCache:
+    '''
+    LRU cache of File/Directory objects by path.
+
+    Entries older than `ttl` (`negative_ttl` for nonexistent ones)
+    are reported as expired, and should be refreshed and stored again.
+    '''
+    __slots__ = ('maxsize', 'ttl', 'negative_ttl', 'data', 'lock')
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL,
+                 negative_ttl=NEGATIVE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # path: (time stored, obj)
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, path):
+        return path in self.data
+
+    def __setitem__(self, path, obj):
+        with self.lock:
+            self.data[path] = (time.monotonic(), obj)
+            self.data.move_to_end(path)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def get(self, path):
+        with self.lock:
+            item = self.data.get(path)
+            if item is None:
+                return None
+            self.data.move_to_end(path)
+            return item[1]
+
+    def expired(self, path):
+        item = self.data.get(path)
+        if item is None:
+            return False
+        stored, obj = item
+        ttl = self.ttl if obj.exist else self.negative_ttl
+        return time.monotonic() - stored > ttl
+
+
 class File(io.IOBase):
     __slots__ = (
         'baseurl', 'path', 'url', 'stat', 'init',
-        'exist', '_readable', '_seekable', 'offset'
+        'exist', '_readable', '_seekable', 'offset',
+        '_stream', '_next_offset', '_lock'
     )
 
     def __init__(self, baseurl, path):
@@ -116,6 +193,11 @@ class File(io.IOBase):
         self._readable = True
         self._seekable = False
         self.offset = 0
+        # open-ended response kept for sequential reads
+        self._stream = None
+        self._next_offset = -1
+        # shared by all handles on the path, see close_stream
+        self._lock = threading.RLock()
 
     def get_stat(self):
         req = SESSION.head(self.url, timeout=CONFIG[
@@ -132,10 +214,13 @@ class File(io.IOBase):
             raise IsADirectory()
         else:
             req.raise_for_status()
+        self.stat.setmode(0o444)
+        self.exist = True
+        self._readable = True
         self.stat.st_size = int(req.headers.get('Content-Length', 0))
         lm = req.headers.get('Last-Modified')
         if lm:
-            self.stat.settime(time.mktime(parsedate(lm)))
+            self.stat.settime(calendar.timegm(parsedate(lm)))
         else:
             self.stat.settime(time.time())
         if req.headers.get('Accept-Ranges') == 'bytes':
@@ -152,21 +237,56 @@ class File(io.IOBase):
             raise fuse.FuseOSError(EIO)
         if offset is None:
             offset = self.offset
+        if offset >= self.stat.st_size:
+            return b''
         end = min(self.stat.st_size, offset + size - 1)
-        brange = '%d-%d' % (offset, end)
+        with self._lock:
+            try:
+                if self._stream is not None and offset == self._next_offset:
+                    content = self._read_stream(size, offset, end)
+                else:
+                    self.close_stream()
+                    if offset and offset == self._next_offset:
+                        # sequential reads, continue in one response
+                        req = self._request(offset)
+                        if (req.status_code == 206 and
+                            'Content-Encoding' not in req.headers):
+                            self._stream = req
+                            content = self._read_stream(size, offset, end)
+                        else:
+                            content = self._read_response(req, size)
+                    else:
+                        content = self._read_response(
+                            self._request(offset, end), size)
+            except fuse.FuseOSError:
+                raise
+            except STREAM_ERRORS:
+                self.close_stream()
+                raise fuse.FuseOSError(EIO)
+            self._next_offset = offset + len(content)
+        if self._seekable:
+            self.offset = end
+        return content
+
+    def _request(self, offset, end=None):
+        brange = '%d-%s' % (offset, '' if end is None else end)
         headers = {'range': 'bytes=' + brange}
         req = SESSION.get(self.url, headers=headers,
                           stream=True, timeout=CONFIG['timeout'])
         if req.status_code == 206:
             self._seekable = True
-        elif req.status_code == 416:
+            return req
+        elif req.status_code == 200:
+            self._seekable = False
+            if offset == 0:
+                return req
+        req.close()
+        if req.status_code == 416:
             # we may have a wrong size
             self.get_stat()
             raise fuse.FuseOSError(EIO)
         elif req.status_code == 200:
-            self._seekable = False
-            if offset != 0:
-                raise fuse.FuseOSError(EIO)
+            raise fuse.FuseOSError(EIO)
         elif req.status_code == 403:
             self._readable = False
             raise fuse.FuseOSError(EACCES)
@@ -177,16 +297,48 @@ class File(io.IOBase):
         else:
             self._readable = False
             raise fuse.FuseOSError(EIO)
-        content = bytes()
+
+    def _read_response(self, req, size):
+        content = bytearray(size)
+        buf = memoryview(content)
+        pos = 0
         for chunk in req.iter_content(CONTENT_CHUNK_SIZE, False):
-            content += chunk
-            if len(content) > size:
-                content = content[:size]
+            n = min(len(chunk), size - pos)
+            buf[pos:pos+n] = chunk[:n]
+            pos += n
+            if pos >= size:
                 break
         req.close()
-        if self._seekable:
-            self.offset = end
-        return content
+        return bytes(buf[:pos])
+
+    def _read_stream(self, size, offset, end):
+        content = bytearray(size)
+        buf = memoryview(content)
+        pos = 0
+        try:
+            while pos < size:
+                chunk = self._stream.raw.read(size - pos)
+                if not chunk:
+                    break
+                buf[pos:pos+len(chunk)] = chunk
+                pos += len(chunk)
+        except STREAM_ERRORS:
+            logging.info('stream broken: %s at %d', self.url, offset + pos)
+            pos = -1
+        if pos < size:
+            self.close_stream()
+        if pos < min(size, self.stat.st_size - offset):
+            # the server may close a kept response, e.g. after a pause
+            # longer than its send timeout: retry with a bounded request
+            return self._read_response(self._request(offset, end), size)
+        return bytes(buf[:pos])
+
+    def close_stream(self):
+        # a handle may be released while another one is reading
+        with self._lock:
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
 
     def readable(self):
         return self._readable
@@ -204,29 +356,77 @@ class File(io.IOBase):
 
 class Directory:
     __slots__ = (
-        'baseurl', 'path', 'url', 'stat', 'content', 'init', 'exist', '_readable'
+        'baseurl', 'path', 'url', 'stat', 'content', 'init', 'exist',
+        '_readable', '_listing', '_etag', '_lastmod', '_expires'
     )
 
     def __init__(self, baseurl, path):
         self.baseurl = baseurl
         self.path = path
         self.url = make_url(baseurl, path)
-        self.stat = FileStat()
-        self.stat.setmode(0o555, True)
-        self.stat.st_nlink = 2
-        self.content = ['.', '..']
+        self.stat = FileStat(stat.S_IFDIR | 0o555, 2)
+        # (name, metacache key)
+        key = path.rstrip('/') or '/'
+        self.content = [('.', key), ('..', os.path.dirname(key))]
         self.init = 0
         self.exist = True
         self._readable = True
+        # last parsed listing and its cache validators
+        self._listing = None
+        self._etag = None
+        self._lastmod = None
+        self._expires = 0
 
-    def read(self):
+    def get_stat(self):
+        req = SESSION.head(self.url, timeout=CONFIG[
+                           'timeout'], allow_redirects=False)
+        req.close()
+        if 400 <= req.status_code <= 499:
+            self.stat.setmode(0o000, True)
+            self.init = 2
+            self._readable = False
+            if req.status_code == 404:
+                self.exist = False
+            return self.stat
+        elif req.status_code >= 500:
+            req.raise_for_status()
+        self.stat.setmode(0o555, True)
+        self.exist = True
+        self._readable = True
+        lm = req.headers.get('Last-Modified')
+        if lm:
+            self.stat.settime(calendar.timegm(parsedate(lm)))
+        else:
+            self.stat.settime(time.time())
+        # the listing wasn't fetched, revalidate it on the next readdir
+        self.init = 1
+        return self.stat
+
+    def fetch(self):
+        '''
+        Fetch and parse the listing, unless the last one is still fresh
+        or the server says it's not modified.
+        '''
+        if self._listing is not None and time.monotonic() < self._expires:
+            return self._listing
+        headers = {}
+        if self._listing is not None:
+            if self._etag:
+                headers['If-None-Match'] = self._etag
+            if self._lastmod:
+                headers['If-Modified-Since'] = self._lastmod
         try:
-            req = SESSION.get(self.url, timeout=CONFIG['timeout'])
+            req = SESSION.get(self.url, headers=headers,
+                              timeout=CONFIG['timeout'])
         except Exception:
             raise fuse.FuseOSError(EIO)
+        self._expires = time.monotonic() + cache_max_age(req.headers)
+        if req.status_code == 304 and self._listing is not None:
+            return self._listing
         try:
             req.raise_for_status()
         except requests.exceptions.HTTPError:
+            self._listing = None
             self.stat.setmode(0o000, True)
             self.init = 2
             self._readable = False
@@ -239,37 +439,47 @@ class Directory:
                 raise fuse.FuseOSError(EIO)
         lm = req.headers.get('Last-Modified')
         if lm:
-            self.stat.settime(time.mktime(parsedate(lm)))
+            self.stat.settime(calendar.timegm(parsedate(lm)))
         else:
             self.stat.settime(time.time())
         try:
-            cwd, listing = parse_dir(req.content)
+            cwd, listing = parse_dir(
+                req.content, req.headers.get('Server', ''))
         except Exception:
             logging.exception('failed to parse listing: ' + self.url)
             listing = []
-        content = ['.', '..']
+        self._listing = listing
+        self._etag = req.headers.get('ETag')
+        self._lastmod = lm
+        return listing
+
+    def read(self):
+        listing = self.fetch()
+        content = self.content[:2]
         objmap = {}
         for name, modified, size, description in listing:
             fpath = os.path.join(self.path, name)
             if name[-1] == '/':
                 fileobj = Directory(self.baseurl, fpath)
                 fpath = fpath.rstrip('/')
+                fileobj.init = 1
             else:
                 fileobj = File(self.baseurl, fpath)
-                if size is None:
-                    fileobj.get_stat()
-                else:
+                # without a size, leave it to the first getattr to HEAD
+                if size is not None:
                     fileobj.stat.st_size = size
+                    fileobj.init = 1
             if modified:
                 fileobj.stat.settime(calendar.timegm(modified))
             else:
                 fileobj.stat.settime(self.stat.st_mtime)
-            fileobj.init = fileobj.init or 1
-            content.append(name.rstrip('/'))
+            content.append((name.rstrip('/'), fpath))
             objmap[fpath] = fileobj
         self.content = content
         self.stat.st_nlink = len(content)
+        self.stat.setmode(0o555, True)
         self.init = 2
+        self.exist = True
         self._readable = True
         return objmap
 
@@ -285,12 +495,13 @@ class rehttpfs(fuse.LoggingMixIn, fuse.Operations):
         if url[-1] != '/':
             self.url += '/'
         self.fd = 0
-        self.metacache = {'/': Directory(self.url, '/')}
+        self.metacache = MetaCache()
+        self.metacache['/'] = Directory(self.url, '/')
 
     def _getpath(self, path, refresh=False):
         pathobj = self.metacache.get(path)
-        if isinstance(pathobj, Directory):
-            return self._getdirobj(path, refresh)
+        if path == '/' or isinstance(pathobj, Directory):
+            return self._getdirobj(path, refresh, True)[0]
         else:
             return self._getfileobj(path, refresh)
 
@@ -298,7 +509,8 @@ class rehttpfs(fuse.LoggingMixIn, fuse.Operations):
         while path != '/':
             path = os.path.dirname(path)
             if path not in self.metacache:
-                self.metacache[path] = Directory(self.url, path + '/')
+                self.metacache[path] = Directory(
+                    self.url, path.rstrip('/') + '/')
             else:
                 break
 
@@ -307,8 +519,10 @@ class rehttpfs(fuse.LoggingMixIn, fuse.Operations):
         fileobj = self.metacache.get(path)
         try:
             if fileobj:
-                if not fileobj.init or refresh:
+                if (not fileobj.init or refresh or
+                    self.metacache.expired(path)):
                     fileobj.get_stat()
+                    self.metacache[path] = fileobj
             else:
                 self._makeparents(path)
                 fileobj = File(self.url, path)
@@ -316,30 +530,64 @@ class rehttpfs(fuse.LoggingMixIn, fuse.Operations):
                 self.metacache[path] = fileobj
         except IsADirectory:
             logging.info('IsADirectory: %s', path)
-            return self._getdirobj(path, refresh)
+            return self._getdirobj(path, refresh, True)[0]
         return fileobj
 
-    def _getdirobj(self, path, refresh=False):
+    def _getdirobj(self, path, refresh=False, stat_only=False):
+        '''
+        Get the Directory at `path`, reading its listing if needed.
+        With `stat_only`, only a HEAD request is made for a new directory.
+
+        Returns the Directory, and the objects in its listing if it was
+        read, or None.
+        '''
         logging.debug('_getdirobj: %s', path)
-        path = path.rstrip('/')
+        path = path.rstrip('/') or '/'
         dirobj = self.metacache.get(path)
-        if dirobj:
-            if not dirobj.init or refresh:
-                objmap = dirobj.read()
-                self._update_metacache(objmap)
-        else:
+        if not dirobj:
             self._makeparents(path)
-            dirobj = Directory(self.url, path + '/')
+            dirobj = Directory(self.url, path.rstrip('/') + '/')
+        elif ((dirobj.init == 2 or dirobj.init and stat_only) and
+              not (refresh or self.metacache.expired(path))):
+            return dirobj, None
+        if stat_only:
+            try:
+                dirobj.get_stat()
+            finally:
+                self.metacache[path] = dirobj
+            return dirobj, None
+        return dirobj, self._readdirobj(path, dirobj)
+
+    def _readdirobj(self, path, dirobj):
+        try:
             objmap = dirobj.read()
             self._update_metacache(objmap)
+        finally:
+            # stored after its children, so a large listing can't evict it;
+            # also keeps failures (e.g. 404) until they expire
             self.metacache[path] = dirobj
-        return dirobj
+        return objmap
 
     def _update_metacache(self, objmap):
+        '''
+        Store the objects from a directory listing. This also renews the
+        cached children, so they aren't each HEADed when they expire.
+        '''
         for name, obj in objmap.items():
             cached = self.metacache.get(name)
-            if not (cached and cached.init and type(cached) == type(obj)):
-                self.metacache[name] = obj
+            if (cached and cached.init and cached.exist and
+                cached.readable() and type(cached) == type(obj)):
+                if isinstance(obj, Directory):
+                    # keep its listing, but revalidate it on the next readdir
+                    cached.stat.settime(obj.stat.st_mtime)
+                    cached.init = 1
+                elif (cached.init == 1 or
+                      obj.stat.st_mtime > cached.stat.st_mtime):
+                    # a HEAD gives the exact size, keep it while unchanged
+                    cached.stat = obj.stat
+                    cached.init = obj.init
+                obj = cached
+            self.metacache[name] = obj
 
     def access(self, path, amode):
         if amode & os.W_OK:
@@ -370,16 +618,34 @@ class rehttpfs(fuse.LoggingMixIn, fuse.Operations):
         fileobj = self._getfileobj(path, False)
         return fileobj.read(size, offset)
 
+    def release(self, path, fh):
+        fileobj = self.metacache.get(path)
+        if isinstance(fileobj, File):
+            fileobj.close_stream()
+        return 0
+
     def readdir(self, path, fh):
         logging.debug('readdir: %s', path)
-        dirobj = self._getdirobj(path)
-        if dirobj.init != 2:
-            objmap = dirobj.read()
-            self._update_metacache(objmap)
+        dirobj, objmap = self._getdirobj(path)
+        if not dirobj.exist:
+            raise fuse.FuseOSError(ENOENT)
+        elif not dirobj.readable():
+            raise fuse.FuseOSError(EACCES)
         content = []
-        for name in dirobj.content:
-            fpath = os.path.normpath(os.path.join(path, name))
-            content.append((name, self.metacache[fpath].stat, 0))
+        for name, fpath in dirobj.content:
+            obj = self.metacache.get(fpath)
+            if obj is None:
+                # evicted from metacache
+                if name in ('.', '..'):
+                    obj = self._getdirobj(fpath, stat_only=True)[0]
+                else:
+                    if objmap is None:
+                        objmap = self._readdirobj(
+                            path.rstrip('/') or '/', dirobj)
+                    obj = objmap.get(fpath)
+                    if obj is None:
+                        continue
+            content.append((name, obj.stat, 0))
         return content
 
 
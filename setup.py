@@ -20,6 +20,7 @@ setup(
     packages=['htmllistparse'],
     install_requires=[
         'beautifulsoup4',
+        'lxml',
         'html5lib',
         'requests',
         'fusepy'